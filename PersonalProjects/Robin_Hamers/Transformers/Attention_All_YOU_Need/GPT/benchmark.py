@@ -0,0 +1,407 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Benchmarks for the GPT of bigram.py, run from this folder : python benchmark.py generate
+# =======================================================
+
+import argparse
+import os
+import resource
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+import bigram
+from bigram import (BatchPrefetcher, BigramLanguageModel, block_size, device, estimate_loss, fuse_attention_weights,
+                    get_batch, learning_rate, masks, vocab_size)
+from profiler import OpCounter
+from tokenizer import CharTokenizer
+
+
+def tokens_per_sec(model, max_new_tokens, use_cache, batch=1):
+    context = torch.zeros((batch, 1), dtype=torch.long, device=device)
+    start = time.perf_counter()
+    model.generate(context, max_new_tokens=max_new_tokens, use_cache=use_cache)
+    return batch * max_new_tokens / (time.perf_counter() - start)
+
+
+def bench_generate(args):
+    # compare the full forward per token against the kv cache (the weights do not matter for the speed)
+    model = BigramLanguageModel(vocab_size).to(device)
+    model.eval()
+
+    # same seed, same samples : both paths must produce the same text
+    torch.manual_seed(1337)
+    ref = model.generate(torch.zeros((1, 1), dtype=torch.long, device=device), args.tokens, use_cache=False)
+    torch.manual_seed(1337)
+    out = model.generate(torch.zeros((1, 1), dtype=torch.long, device=device), args.tokens, use_cache=True)
+    print(f"identical samples : {torch.equal(ref, out)}")
+
+    print(f"block_size = {block_size}, batch = {args.batch}")
+    print(f"{'new tokens':>10} | {'no cache tok/s':>14} | {'kv cache tok/s':>14} | speedup")
+    for n in args.lengths:
+        full = tokens_per_sec(model, n, use_cache=False, batch=args.batch)
+        cached = tokens_per_sec(model, n, use_cache=True, batch=args.batch)
+        print(f"{n:>10} | {full:>14.1f} | {cached:>14.1f} | {cached / full:.2f}x")
+
+
+def forward_time(model, x, repeats):
+    model(x) # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model(x)
+    return (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def bench_attention(args):
+    # per Head model, then the same weights converted to the fused layout
+    bigram.fused_attention = False
+    heads = BigramLanguageModel(vocab_size).to(device).eval()
+    bigram.fused_attention = True
+    fused = BigramLanguageModel(vocab_size).to(device).eval()
+    fused.load_state_dict(fuse_attention_weights(heads.state_dict()))
+
+    x = torch.randint(vocab_size, (args.batch, block_size), device=device)
+    ref, _ = heads(x)
+    out, _ = fused(x)
+    print(f"max |logits difference| after conversion : {(ref - out).abs().max().item():.2e}")
+
+    t_heads = forward_time(heads, x, args.repeats)
+    t_fused = forward_time(fused, x, args.repeats)
+    print(f"forward ({args.batch}, {block_size}) : per head {t_heads*1000:.1f} ms, fused {t_fused*1000:.1f} ms, {t_heads / t_fused:.2f}x")
+
+
+def forward_allocations(model, *args, **kwargs):
+    # tensors allocated by one forward
+    counter = OpCounter(type(model).__name__)
+    with counter:
+        model(*args, **kwargs)
+    return counter.counts[type(model).__name__, 'forward']['allocations']
+
+
+@torch.no_grad()
+def bench_masks(args):
+    # what the causal masks and position indices cost: memory, allocations and time of a forward
+    x = torch.randint(vocab_size, (args.batch, block_size), device=device)
+    print(f"full forward ({args.batch}, {block_size}), decode step after {args.context} tokens")
+    print(f"{'attention':>9} | {'mask memory KB':>14} | {'full fwd allocs':>15} | {'decode allocs':>13} | "
+          f"{'full fwd ms':>11} | {'decode ms/token':>15}")
+    for fused in [False, True]:
+        bigram.fused_attention = fused
+        model = BigramLanguageModel(vocab_size).to(device).eval()
+        full_allocs = forward_allocations(model, x)
+        memory = sum(b.nbytes for b in model.buffers()) + sum(t.nbytes for ts in masks.tensors.values() for t in ts)
+        kv_cache = model.new_kv_cache()
+        model(x[:1, :args.context], kv_cache=kv_cache)
+        decode_allocs = forward_allocations(model, x[:1, :1], kv_cache=kv_cache, start_pos=args.context)
+        t_full = forward_time(model, x, args.repeats)
+        t_decode = 1 / tokens_per_sec(model, args.tokens, use_cache=True)
+        print(f"{'fused' if fused else 'per head':>9} | {memory / 1024:>14.0f} | {full_allocs:>15} | {decode_allocs:>13} | "
+              f"{t_full*1000:>11.1f} | {t_decode*1000:>15.2f}")
+
+
+def bench_compile(args):
+    # eager against torch.compile: train steps and generate, the first compiled call is timed apart (compilation)
+    bigram.batch_size = args.batch_size
+    model = BigramLanguageModel(vocab_size).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    rows = []
+    for compile_model in [False, True]:
+        bigram.compile_model = compile_model
+        forward = bigram.compiled(model)
+        model.train()
+        start = time.perf_counter()
+        train_step_time(forward, optimizer, lambda: get_batch('train'), 1)
+        t_first_step = time.perf_counter() - start
+        t_step = train_step_time(forward, optimizer, lambda: get_batch('train'), args.steps)
+        model.eval()
+        start = time.perf_counter()
+        model.generate(torch.zeros((1, 1), dtype=torch.long, device=device), max_new_tokens=2)
+        t_first_token = time.perf_counter() - start
+        rows.append((compile_model, t_first_step, t_step, t_first_token, tokens_per_sec(model, args.tokens, use_cache=True)))
+    bigram.compile_model = False
+
+    train_tokens = bigram.batch_size * block_size
+    print(f"train batch ({bigram.batch_size}, {block_size}), {args.steps} steps; generate {args.tokens} tokens")
+    print(f"| mode | first train step (s) | train tokens/s | first generate (s) | generate tokens/s |")
+    print(f"|---|---|---|---|---|")
+    for compile_model, t_first_step, t_step, t_first_token, gen in rows:
+        print(f"| {'torch.compile' if compile_model else 'eager'} | {t_first_step:.1f} | {train_tokens / t_step:.0f} | "
+              f"{t_first_token:.1f} | {gen:.1f} |")
+
+
+def bench_tokenizer(args):
+    with open(args.input, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    start = time.perf_counter()
+    chars = sorted(list(set(text)))
+    t_dict_scan = time.perf_counter() - start
+    stoi = { ch:i for i,ch in enumerate(chars) }
+    itos = { i:ch for i,ch in enumerate(chars) }
+    start = time.perf_counter()
+    ids = [stoi[c] for c in text]
+    t_dict_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    out = ''.join([itos[i] for i in ids])
+    t_dict_decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokenizer = CharTokenizer.from_text(text)
+    t_np_scan = time.perf_counter() - start
+    start = time.perf_counter()
+    array = tokenizer.encode(text)
+    t_np_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    out_np = tokenizer.decode(array)
+    t_np_decode = time.perf_counter() - start
+
+    assert tokenizer.chars == chars and np.array_equal(array, ids) and out_np == out == text
+    print(f"{len(text)} characters of {args.input} (times in ms)")
+    print(f"{'':>18} | {'python dict':>11} | {'numpy':>7}")
+    for name, t_dict, t_np in [('vocabulary scan', t_dict_scan, t_np_scan), ('encode', t_dict_encode, t_np_encode),
+                               ('decode', t_dict_decode, t_np_decode)]:
+        print(f"{name:>18} | {t_dict*1000:>11.1f} | {t_np*1000:>7.1f}")
+
+    batch = array[:64 * block_size].reshape(64, block_size)
+    start = time.perf_counter()
+    rows = [''.join([itos[i] for i in row]) for row in batch.tolist()]
+    t_rows = time.perf_counter() - start
+    start = time.perf_counter()
+    rows_np = tokenizer.decode_batch(batch)
+    t_batch = time.perf_counter() - start
+    assert rows == rows_np
+    print(f"decode of ({batch.shape[0]}, {batch.shape[1]}) : dict per row {t_rows*1000:.2f} ms, decode_batch {t_batch*1000:.2f} ms")
+
+
+def per_row_batch(data):
+    # the get_batch before the gather: one slice and one tensor per row, then torch.stack
+    ix = torch.randint(len(data) - block_size, (bigram.batch_size,))
+    x = torch.stack([torch.from_numpy(data[i:i+block_size].astype(np.int64)) for i in ix])
+    y = torch.stack([torch.from_numpy(data[i+1:i+block_size+1].astype(np.int64)) for i in ix])
+    return x.to(device), y.to(device)
+
+
+def train_step_time(model, optimizer, next_batch, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        xb, yb = next_batch()
+        with bigram.autocast():
+            logits, loss = model(xb, yb)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+    return (time.perf_counter() - start) / steps
+
+
+def bench_prefetch(args):
+    bigram.batch_size = args.batch_size
+    data = np.memmap(bigram.train_file, dtype=bigram.meta['dtype'], mode='r')
+    for name, fn in [('per row slices', lambda: per_row_batch(data)), ('one gather', lambda: get_batch('train'))]:
+        start = time.perf_counter()
+        for _ in range(args.batches):
+            fn()
+        print(f"batch building, {name:>14} : {(time.perf_counter() - start) / args.batches * 1000:.2f} ms")
+
+    model = BigramLanguageModel(vocab_size).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    train_step_time(model, optimizer, lambda: get_batch('train'), 1) # warm up
+    t_sync = train_step_time(model, optimizer, lambda: per_row_batch(data), args.steps)
+    batches = BatchPrefetcher('train', depth=args.depth)
+    t_prefetch = train_step_time(model, optimizer, batches.next, args.steps)
+    batches.close()
+    print(f"train step, batches built in the loop : {t_sync*1000:.1f} ms")
+    print(f"train step, {args.depth} batches prefetched   : {t_prefetch*1000:.1f} ms")
+    print(f"step time reduction : {(1 - t_prefetch / t_sync) * 100:.1f}%")
+
+
+@torch.no_grad()
+def random_batches_loss(model, iters):
+    # the estimate_loss before the fixed eval set: fresh random batches for every evaluation
+    out = {}
+    model.eval()
+    for split in ['train', 'val']:
+        losses = torch.zeros(iters)
+        for k in range(iters):
+            X, Y = get_batch(split)
+            logits, loss = model(X, Y)
+            losses[k] = loss.item()
+        out[split] = losses.mean().item()
+    return out
+
+
+def bench_eval(args):
+    bigram.batch_size = args.batch_size
+    model = BigramLanguageModel(vocab_size).to(device)
+
+    start = time.perf_counter()
+    old = [random_batches_loss(model, args.old_iters) for _ in range(args.repeats)]
+    t_old = (time.perf_counter() - start) / args.repeats
+    start = time.perf_counter()
+    new = [estimate_loss(model) for _ in range(args.repeats)]
+    t_new = (time.perf_counter() - start) / args.repeats
+
+    windows = 2 * bigram.eval_iters * bigram.batch_size
+    old_val = ', '.join(f"{o['val']:.4f}" for o in old)
+    new_val = ', '.join(f"{n['val']:.4f}" for n in new)
+    print(f"random batches : {2 * args.old_iters} forwards of {bigram.batch_size} windows, {t_old:.2f} s, val loss {old_val}")
+    print(f"fixed eval set : {windows} windows by {bigram.eval_batch_size}, {t_new:.2f} s, val loss {new_val}")
+    print(f"{t_old / t_new:.1f}x faster")
+
+
+def bench_precision(args):
+    # same init and same batches for both precisions, then training speed, val loss and sampling speed
+    bigram.batch_size = args.batch_size
+    init = BigramLanguageModel(vocab_size).state_dict()
+    print(f"{args.steps} train steps of batch {args.batch_size} on {bigram.input_file}")
+    print(f"{'precision':>9} | {'steps/s':>7} | {'val loss':>8} | {'generate tok/s':>14}")
+    for precision in ['fp32', 'bf16']:
+        bigram.precision = precision
+        model = BigramLanguageModel(vocab_size).to(device)
+        model.load_state_dict(init)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+        torch.manual_seed(1337)
+        t_step = train_step_time(model, optimizer, lambda: get_batch('train'), args.steps)
+        losses = estimate_loss(model)
+        model.eval()
+        speed = tokens_per_sec(model, args.tokens, use_cache=True)
+        print(f"{precision:>9} | {1 / t_step:>7.2f} | {losses['val']:>8.4f} | {speed:>14.1f}")
+
+
+def ddp_worker(rank, world_size, args, results):
+    bigram.batch_size = args.batch_size
+    bigram.init_distributed(rank, world_size)
+    model = BigramLanguageModel(vocab_size).to(device)
+    if world_size > 1:
+        model = DDP(model, broadcast_buffers=False)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    train_step_time(model, optimizer, lambda: get_batch('train'), 1) # warm up
+    t_step = train_step_time(model, optimizer, lambda: get_batch('train'), args.steps)
+    if rank == 0:
+        results.put(t_step)
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp(args):
+    # every worker trains on batch_size windows: with W workers one step covers W * batch_size windows
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    results = mp.get_context('spawn').SimpleQueue()
+    print(f"{os.cpu_count()} cores, batch {args.batch_size} per worker, {args.steps} steps")
+    print(f"{'workers':>7} | {'steps/s':>7} | {'tokens/s':>8} | speedup")
+    base = None
+    for world_size in args.workers:
+        mp.spawn(ddp_worker, args=(world_size, args, results), nprocs=world_size)
+        steps = 1 / results.get()
+        tokens = steps * world_size * args.batch_size * block_size
+        base = base or tokens
+        print(f"{world_size:>7} | {steps:>7.2f} | {tokens:>8.0f} | {tokens / base:.2f}x")
+
+
+def memory_worker(batch_size, accumulation, checkpointing, steps, results):
+    # fresh process per configuration, so its peak rss is the one of this configuration only
+    bigram.batch_size = batch_size
+    bigram.activation_checkpointing = checkpointing
+    model = BigramLanguageModel(vocab_size).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    start = time.perf_counter()
+    for _ in range(steps):
+        optimizer.zero_grad(set_to_none=True)
+        for _ in range(accumulation):
+            xb, yb = get_batch('train')
+            with bigram.autocast():
+                logits, loss = model(xb, yb)
+            (loss / accumulation).backward()
+        optimizer.step()
+    t_step = (time.perf_counter() - start) / steps
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, t_step))
+
+
+def bench_memory(args):
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    print(f"block_size {block_size}, n_layer {bigram.n_layer}, n_embd {bigram.n_embd}, {args.steps} steps")
+    print(f"{'batch':>5} x {'accum':>5} = {'effective':>9} | {'checkpointing':>13} | {'peak rss MB':>11} | {'s/step':>6}")
+    for config in args.configs:
+        batch, accumulation = (int(v) for v in config.split('x'))
+        for checkpointing in [False, True]:
+            p = ctx.Process(target=memory_worker, args=(batch, accumulation, checkpointing, args.steps, results))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                print(f"{batch:>5} x {accumulation:>5} = {batch * accumulation:>9} | {str(checkpointing):>13} | "
+                      f"{'killed (out of memory?)':>20}")
+                continue
+            rss, t_step = results.get()
+            print(f"{batch:>5} x {accumulation:>5} = {batch * accumulation:>9} | {str(checkpointing):>13} | {rss:>11.0f} | {t_step:>6.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks for the GPT of bigram.py')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('generate', help='tokens/sec of generate with and without the kv cache')
+    p.add_argument('--tokens', type=int, default=100, help='tokens sampled for the equality check')
+    p.add_argument('--lengths', type=int, nargs='+', default=[100, 250, 500])
+    p.add_argument('--batch', type=int, default=1)
+    p.set_defaults(func=bench_generate)
+
+    p = sub.add_parser('attention', help='per Head attention against the fused qkv attention')
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=bench_attention)
+
+    p = sub.add_parser('masks', help='memory, allocations and time of the causal masks and position indices')
+    p.add_argument('--batch', type=int, default=16)
+    p.add_argument('--context', type=int, default=128, help='tokens in the kv cache before the timed decode step')
+    p.add_argument('--tokens', type=int, default=200, help='tokens generated to time the decode steps')
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=bench_masks)
+
+    p = sub.add_parser('compile', help='eager against torch.compile: train tokens/s and generate tokens/s')
+    p.add_argument('--steps', type=int, default=5)
+    p.add_argument('--tokens', type=int, default=200)
+    p.add_argument('--batch-size', type=int, default=8)
+    p.set_defaults(func=bench_compile)
+
+    p = sub.add_parser('tokenizer', help='dict lookups against the numpy tokenizer on a text file')
+    p.add_argument('--input', default='input.txt')
+    p.set_defaults(func=bench_tokenizer)
+
+    p = sub.add_parser('prefetch', help='train step time with batches built in the loop or prefetched')
+    p.add_argument('--batches', type=int, default=200, help='batches built to time the batch building alone')
+    p.add_argument('--steps', type=int, default=10)
+    p.add_argument('--depth', type=int, default=4)
+    p.add_argument('--batch-size', type=int, default=bigram.batch_size)
+    p.set_defaults(func=bench_prefetch)
+
+    p = sub.add_parser('eval', help='random batches estimate_loss against the fixed eval set')
+    p.add_argument('--old-iters', type=int, default=200, help='random batches per split of the old estimate_loss')
+    p.add_argument('--repeats', type=int, default=2)
+    p.add_argument('--batch-size', type=int, default=bigram.batch_size)
+    p.set_defaults(func=bench_eval)
+
+    p = sub.add_parser('precision', help='fp32 against bf16 autocast: train speed, final val loss and sampling speed')
+    p.add_argument('--steps', type=int, default=200)
+    p.add_argument('--tokens', type=int, default=200)
+    p.add_argument('--batch-size', type=int, default=bigram.batch_size)
+    p.set_defaults(func=bench_precision)
+
+    p = sub.add_parser('ddp', help='steps/s of the gloo data parallel training for several numbers of workers')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.add_argument('--steps', type=int, default=10)
+    p.add_argument('--batch-size', type=int, default=bigram.batch_size)
+    p.set_defaults(func=bench_ddp)
+
+    p = sub.add_parser('memory', help='peak rss of a train step with gradient accumulation and activation checkpointing')
+    p.add_argument('--configs', nargs='+', default=['64x1', '16x4', '8x8'], help='batch_size x accumulation steps')
+    p.add_argument('--steps', type=int, default=2)
+    p.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
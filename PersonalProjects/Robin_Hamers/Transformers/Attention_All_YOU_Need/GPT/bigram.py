@@ -5,10 +5,25 @@
 # Description: Attention is all you need - Build a GPT from scratch, helped with Andrej Kartpathy video "Let's build GPT: from scratch, in code, spelled out"
 # =======================================================
 
-import sentencepiece as spm
+import contextlib
+import copy
+import os
+import pickle
+import queue
+import threading
+
+import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+from checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
+from prepare import corpus_paths, input_key, prepare, prepare_subword, subword_tokenizer
+from profiler import LayerProfiler
+from tokenizer import CharTokenizer
 
 
 # hyperparameters
@@ -18,62 +33,277 @@ max_iters = 5000
 eval_interval = 500
 learning_rate = 3e-4
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-eval_iters = 200
+eval_iters = 16 # batches of the fixed eval set, the same windows every time so fewer are needed than random ones
+eval_batch_size = 128 # windows per forward pass when evaluating
+eval_in_background = False # evaluate a copy of the model in a thread while training continues
 n_embd = 384
 n_head = 6
 n_layer = 6
 dropout = 0.2
+fused_attention = True # one qkv projection for all the heads instead of a Head module per head
+prefetch_batches = 4 # batches built ahead by a background thread during training (0 = build them in the loop)
+precision = 'fp32' # 'bf16' runs the forward pass and the loss in bfloat16 with torch.autocast, the weights stay fp32
+checkpoint_dir = 'checkpoints'
+checkpoint_interval = 500 # iterations between two checkpoints (0 = never save)
+resume = False # continue from the latest checkpoint of checkpoint_dir, with the same batches as an uninterrupted run
+gradient_accumulation_steps = 1 # batches whose gradients are summed before each optimizer step (effective batch = batch_size * this)
+activation_checkpointing = False # keep only the input of each Block and recompute its activations in backward
+tokenizer_type = 'char' # 'spm': SentencePiece subwords, about 3 characters per token so a block sees 3x more text
+spm_vocab_size = 5000
+compile_model = False # torch.compile the train step and the decode step of generate (eager if it can't compile)
+profile_steps = 0 # time the forward and backward of every module for the first training steps (0 = off, no hooks)
+profile_file = 'profile' # the profile is written to profile.json (summary) and profile.trace.json (chrome trace)
 # ------------------
 
 torch.manual_seed(1337)
 
+# data parallel training: python -m torch.distributed.run --nproc_per_node=4 bigram.py
+ddp_rank = 0 # this process
+ddp_world_size = 1 # number of training processes, set by init_distributed
+
+def init_distributed(rank, world_size):
+    # one process per worker, each trains on its own shard of the data and the gradients are all-reduced (gloo)
+    global ddp_rank, ddp_world_size
+    ddp_rank, ddp_world_size = rank, world_size
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+    # share the cores between the processes instead of every process starting a thread per core
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
 #wget https://raw.githubusercontent.com/karpathy/char-rnn/master/data/tinyshakespeare/input.txt
-with open('input.txt', 'r', encoding= 'utf-8') as f:
-    text = f.read()
+# the text is tokenized once by prepare.py, then the tokens are read from memory-mapped files
+# named after the size and modification time of input.txt, so they are made again when the corpus changes
+input_file = 'input.txt'
+corpus_key = input_key(input_file) # one stat, the text itself is only read to make the files
+if tokenizer_type == 'spm':
+    # the subword model is trained once, and the corpus encoded once per model: its files are named after its hash
+    tokenizer = subword_tokenizer(input_file, spm_vocab_size, corpus_key)
+    train_file, val_file, meta_file = corpus_paths(input_file, corpus_key, tokenizer)
+    if not os.path.exists(meta_file):
+        prepare_subword(input_file, tokenizer, corpus_key)
+else:
+    train_file, val_file, meta_file = corpus_paths(input_file, corpus_key)
+    if not os.path.exists(meta_file):
+        prepare(input_file, key=corpus_key)
+with open(meta_file, 'rb') as f:
+    meta = pickle.load(f)
 
 # here are all the tokens :
-"""vocab_size = 5000
-spm.SentencePieceTrainer.Train(f'--input=input.txt --model_prefix=spm --vocab_size={vocab_size}')
-s = spm.SentencePieceProcessor(model_file='spm.model')
-data = torch.tensor(s.encode(text, out_type=int, enable_sampling=True, alpha=0.1, nbest_size=-1), dtype=torch.long)
-"""
-chars = sorted(list(set(text)))
-vocab_size = len(chars)
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
-encode = lambda s: [stoi[c] for c in s] # encoder: take a string, output a list of integers
-decode = lambda l: ''.join([itos[i] for i in l]) # decoder: take a list of integers, output a string
-data = torch.tensor(encode(text), dtype=torch.long)
-
-# split train and val data
-n = int(0.9*len(data))
-train_data = data[:n]
-val_data = data[n:]
+if tokenizer_type != 'spm':
+    tokenizer = CharTokenizer(meta['chars'])
+vocab_size = tokenizer.vocab_size
+encode = tokenizer.encode # encoder: take a string, output an array of integers
+decode = tokenizer.decode # decoder: take a list of integers, output a string
 
 # data loading
+def read_windows(split, ix):
+    # the memmap is reopened every batch so the pages it touched are not kept resident by a long lived mapping
+    data = np.memmap(train_file if split == 'train' else val_file, dtype=meta['dtype'], mode='r')
+    # read the (len(ix), block_size+1) windows in one gather, x and y are two views of it
+    window = data[ix.numpy()[:, None] + np.arange(block_size + 1)]
+    window = torch.from_numpy(window.astype(np.int64))
+    x, y = window[:, :-1], window[:, 1:]
+    return x, y
+
+def split_length(split):
+    return len(np.memmap(train_file if split == 'train' else val_file, dtype=meta['dtype'], mode='r'))
+
+def sample_batch(split, generator=None):
+    # generate a smal batch of data of inputs x and targets y, on the cpu
+    # with several processes, each one draws its windows from its own contiguous shard of the split
+    n = split_length(split) - block_size
+    start, end = n * ddp_rank // ddp_world_size, n * (ddp_rank + 1) // ddp_world_size
+    ix = start + torch.randint(end - start, (batch_size,), generator=generator)
+    return read_windows(split, ix)
+
 def get_batch(split):
-    # generate a smal batch of data of inputs x and targets y
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i+block_size] for i in ix])
-    y = torch.stack([data[i+1:i+block_size+1] for i in ix])
+    x, y = sample_batch(split)
     x, y = x.to(device), y.to(device)
     return x, y
 
+class BatchPrefetcher:
+    """ builds the next batches of a split in a background thread, so the train step never waits for data """
+
+    def __init__(self, split, depth=prefetch_batches, seed=1337, generator_state=None):
+        self.split = split
+        # own generator: the thread draws its indices in its own order, the global rng stays for dropout
+        self.generator = torch.Generator().manual_seed(seed)
+        if generator_state is not None:
+            self.generator.set_state(generator_state)
+        # generator state right after the last batch returned by next(): the thread is already some batches
+        # ahead, a checkpoint saves this one so a resumed run draws the same next batch
+        self.generator_state = self.generator.get_state()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped.is_set():
+                x, y = sample_batch(self.split, self.generator)
+                if device == 'cuda':
+                    # page-locked memory lets the copy to the gpu run asynchronously
+                    x, y = x.pin_memory(), y.pin_memory()
+                self._put((x, y, self.generator.get_state()))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # a full queue blocks until the train loop takes a batch, or until close()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        x, y, self.generator_state = item
+        x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+        return x, y
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+def autocast():
+    # only the ops of the forward pass are cast, the parameters and the AdamW state stay fp32 (master weights)
+    return torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+eval_sets = {}
+
+def get_eval_set(split):
+    # start of every window evaluated, drawn once with a fixed seed so the losses of different steps and
+    # checkpoints are measured on exactly the same text
+    if split not in eval_sets:
+        generator = torch.Generator().manual_seed(42)
+        eval_sets[split] = torch.randint(split_length(split) - block_size, (eval_iters * batch_size,), generator=generator)
+    return eval_sets[split]
+
 @torch.no_grad()  # tells pytorch that everything in this function will not call backward it can be a lot more efficient
-def estimate_loss():
+def estimate_loss(model):
     out = {}
     model.eval()
     for split in['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
-            logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+        ix = get_eval_set(split)
+        total = 0.0
+        for i in range(0, len(ix), eval_batch_size):
+            X, Y = read_windows(split, ix[i:i+eval_batch_size])
+            with autocast():
+                logits, loss = model(X.to(device), Y.to(device))
+            # every window has block_size targets, so the mean over the set is the mean of the chunk means
+            total += loss.item() * len(X)
+        out[split] = total / len(ix)
     model.train()
     return out
 
+def report_loss(model, iter):
+    losses = estimate_loss(model)
+    print(f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f} ")
+
+def compiled(fn):
+    """ fn, run through torch.compile when compile_model is set; if it can't be compiled here (no c++ compiler,
+    an op dynamo does not support, ...) it warns once and runs eagerly """
+    state = {'fn': None}
+
+    def call(*args, **kwargs):
+        if not compile_model:
+            return fn(*args, **kwargs)
+        if state['fn'] is None:
+            state['fn'] = torch.compile(fn) if hasattr(torch, 'compile') else fn
+        try:
+            return state['fn'](*args, **kwargs)
+        except Exception as e:
+            if state['fn'] is fn:
+                raise
+            print(f"torch.compile failed, running eagerly: {type(e).__name__}: {e}")
+            state['fn'] = fn
+            return fn(*args, **kwargs)
+    return call
+
+
+class AttentionMasks:
+    """ the causal mask and the position indices of block_size, built once per device and sliced by every
+    attention layer and forward pass, instead of a tril buffer per Head and an arange per forward """
+
+    def __init__(self):
+        self.tensors = {}
+
+    def _get(self, device):
+        if device not in self.tensors:
+            allowed = torch.tril(torch.ones(block_size, block_size, dtype=torch.bool, device=device))
+            self.tensors[device] = (allowed, ~allowed, torch.arange(block_size, device=device))
+        return self.tensors[device]
+
+    def causal(self, T, S, device):
+        # (T,S) True where the last T of S positions may attend, the attn_mask of scaled_dot_product_attention
+        return self._get(device)[0][S-T:S, :S]
+
+    def future(self, T, S, device):
+        # (T,S) True where they may not, for masked_fill
+        return self._get(device)[1][S-T:S, :S]
+
+    def positions(self, start, T, device):
+        return self._get(device)[2][start:start+T]
+
+masks = AttentionMasks() # shared by every model
+
+
+def drop_tril_buffers(module, state_dict, prefix, *args):
+    # checkpoints saved before AttentionMasks hold a tril buffer in every attention module
+    for name in [name for name in state_dict if name.startswith(prefix) and name.endswith('.tril')]:
+        del state_dict[name]
+
+
+class KVCache:
+    """ keys and values already computed during generation, so each new token only has to attend from its own position
+
+    A static cache always returns its whole block_size buffers and counts its size in a tensor: the shapes and
+    the inputs of a decode step never change, so it is compiled once. The caller masks the slots not written yet. """
+
+    def __init__(self, static=False):
+        self.k = None
+        self.v = None
+        self.size = 0
+        self.static = static
+
+    def update(self, k, v):
+        # write the keys/values of the new positions after the cached ones and return everything seen so far
+        T = k.shape[-2]
+        if self.k is None:
+            shape = (*k.shape[:-2], block_size, k.shape[-1])
+            if self.static:
+                # zeros: the masked slots get a 0 attention weight, and 0 * nan would still be nan
+                self.k = k.new_zeros(shape)
+                self.v = v.new_zeros(shape)
+                self.size = torch.zeros((), dtype=torch.long, device=k.device)
+            else:
+                self.k = k.new_empty(shape)
+                self.v = v.new_empty(shape)
+        if self.static:
+            slots = self.size + masks.positions(0, T, k.device)
+            self.k.index_copy_(-2, slots, k)
+            self.v.index_copy_(-2, slots, v)
+            self.size += T
+            return self.k, self.v
+        self.k[..., self.size:self.size+T, :] = k
+        self.v[..., self.size:self.size+T, :] = v
+        self.size += T
+        return self.k[..., :self.size, :], self.v[..., :self.size, :]
+
+    def truncate(self, size):
+        # forget the positions from size on, ex: draft tokens that were rejected
+        self.size = min(self.size, size)
+
+    def select(self, rows):
+        # keep only some sequences of the batch, ex: drop the ones that finished generating
+        if self.k is not None:
+            self.k, self.v = self.k[rows], self.v[rows]
+
+
 class Head(nn.Module):
     """ one head of self-attention """
 
@@ -82,22 +312,28 @@ class Head(nn.Module):
         self.key = nn.Linear(n_embd, head_size, bias=False)
         self.query = nn.Linear(n_embd, head_size, bias=False)
         self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
 
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
         B,T,C = x.shape
         k = self.key(x) # (B,T,C)
         q = self.query(x) # (B,T,C)
+        v = self.value(x) # (B,T,C)
+        if kv_cache is not None:
+            # attend over the cached positions too, the queries are only the new ones
+            k, v = kv_cache.update(k, v) # (B,S,C) with S the number of positions seen so far
+        S = k.shape[1]
         # compute attention scores ("affinities")
-        wei = q @ k.transpose(-2,-1) * C**-0.5 # (B,T,C) @ (B,C,T) ---> (B,T,T)
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B,T,T)
-        wei = F.softmax(wei, dim=-1) # (B,T,T)
+        wei = q @ k.transpose(-2,-1) * C**-0.5 # (B,T,C) @ (B,C,S) ---> (B,T,S)
+        if attn_mask is None:
+            wei = wei.masked_fill(masks.future(T, S, x.device), float('-inf')) # (B,T,S)
+        else:
+            wei = wei.masked_fill(~attn_mask, float('-inf'))
+        wei = F.softmax(wei, dim=-1) # (B,T,S)
         wei = self.dropout(wei)
         # perform the weighted aggregation of the values
-        v = self.value(x) # (B,T,C)
-        out = wei @ v # (B,T,T) @ (B,C,T) ---> (B,T,C)
+        out = wei @ v # (B,T,S) @ (B,S,C) ---> (B,T,C)
         return out
     
 
@@ -110,11 +346,93 @@ class MultiHeadAttention(nn.Module):
         self.proj = nn.Linear(n_embd, n_embd)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        if kv_cache is None:
+            out = torch.cat([h(x, attn_mask=attn_mask) for h in self.heads], dim=-1)
+        else:
+            out = torch.cat([h(x, c, attn_mask) for h, c in zip(self.heads, kv_cache)], dim=-1)
+        out = self.dropout(self.proj(out))
+        return out
+
+    def new_kv_cache(self, static=False):
+        return [KVCache(static) for _ in self.heads]
+
+
+class FusedMultiHeadAttention(nn.Module):
+    """ the same heads as MultiHeadAttention, computed with one qkv projection and a head dimension """
+
+    def __init__(self, num_heads, head_size):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # rows are [query of every head, key of every head, value of every head], see fuse_attention_weights
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+        self.proj = nn.Linear(n_embd, n_embd)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        B,T,C = x.shape
+        q, k, v = self.qkv(x).split(self.num_heads * self.head_size, dim=-1)
+        # (B,T,nh*hs) ---> (B,nh,T,hs)
+        q = q.view(B, T, self.num_heads, self.head_size).transpose(1, 2)
+        k = k.view(B, T, self.num_heads, self.head_size).transpose(1, 2)
+        v = v.view(B, T, self.num_heads, self.head_size).transpose(1, 2)
+        if kv_cache is not None:
+            k, v = kv_cache.update(k, v) # (B,nh,S,hs)
+        S = k.shape[-2]
+        # Head scales by the embedding size, not the head size, keep it so trained weights give the same outputs
+        if hasattr(F, 'scaled_dot_product_attention'):
+            if attn_mask is not None:
+                mask, causal = attn_mask.unsqueeze(1), False # same mask for every head
+            elif T == S:
+                mask, causal = None, True
+            else:
+                # the new queries sit at the end of the sequence, is_causal would align them at the start
+                mask, causal = masks.causal(T, S, x.device), False
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, is_causal=causal,
+                                                 dropout_p=dropout if self.training else 0.0, scale=C**-0.5)
+        else:
+            wei = q @ k.transpose(-2,-1) * C**-0.5 # (B,nh,T,S)
+            if attn_mask is None:
+                wei = wei.masked_fill(masks.future(T, S, x.device), float('-inf'))
+            else:
+                wei = wei.masked_fill(~attn_mask.unsqueeze(1), float('-inf'))
+            wei = F.softmax(wei, dim=-1)
+            wei = F.dropout(wei, dropout, self.training)
+            out = wei @ v # (B,nh,T,hs)
+        # put the heads back side by side, in the order torch.cat gives in MultiHeadAttention
+        out = out.transpose(1, 2).contiguous().view(B, T, C)
         out = self.dropout(self.proj(out))
         return out
 
+    def new_kv_cache(self, static=False):
+        return KVCache(static)
+
+
+def fuse_attention_weights(state_dict):
+    """ convert a state_dict saved with the per Head MultiHeadAttention to the FusedMultiHeadAttention layout
+    ex: model.load_state_dict(fuse_attention_weights(torch.load('model.pt'))) """
+    fused = {}
+    heads = {}
+    for name, tensor in state_dict.items():
+        if '.sa.heads.' not in name:
+            fused[name] = tensor
+            continue
+        # blocks.0.sa.heads.3.key.weight -> prefix 'blocks.0.sa', head 3, projection 'key'
+        prefix, rest = name.split('.heads.')
+        head, proj = rest.split('.')[:2]
+        if proj == 'tril': # the causal mask is shared now, see AttentionMasks
+            continue
+        heads.setdefault(prefix, {}).setdefault(proj, {})[int(head)] = tensor
+    for prefix, projs in heads.items():
+        # each head weight is (head_size, n_embd): stack the heads of each projection, then query/key/value
+        fused[prefix + '.qkv.weight'] = torch.cat([
+            torch.cat([projs[proj][h] for h in sorted(projs[proj])], dim=0)
+            for proj in ('query', 'key', 'value')
+        ], dim=0)
+    return fused
+
+
 class FeedForward(nn.Module):
     """ a simple linear layer followed by a non linearity"""
 
@@ -133,16 +451,20 @@ class FeedForward(nn.Module):
 
 class Block(nn.Module):
     """ Transformer block : communication followed by computation"""
-    def __init__(self, n_embd, n_head):
+    def __init__(self, n_embd, n_head, fused=None):
         super().__init__()
         head_size = n_embd // n_head
-        self.sa = MultiHeadAttention(n_head, head_size)
+        # fused : the attention layout, None = the fused_attention global when the block is built
+        if fused_attention if fused is None else fused:
+            self.sa = FusedMultiHeadAttention(n_head, head_size)
+        else:
+            self.sa = MultiHeadAttention(n_head, head_size)
         self.ffwd = FeedForward(n_embd)
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
 
-    def forward(self, x):
-        x = x + self.sa(self.ln1(x))
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        x = x + self.sa(self.ln1(x), kv_cache, attn_mask)
         x = x + self.ffwd(self.ln2(x))
         return x
 
@@ -150,23 +472,41 @@ class Block(nn.Module):
 # Decoder Only Transformer
 class BigramLanguageModel(nn.Module):
     
-    def __init__(self,vocab_size):
+    def __init__(self,vocab_size, n_layer=n_layer, fused=None):
         super().__init__()
+        # n_layer : fewer blocks for a small draft model, see speculative.py
+        # fused : the attention layout of saved weights, ex: an int8 export of quantize.py (None = fused_attention,
+        # read when the model is built so a script can change it at runtime)
+        self.fused_attention = fused_attention if fused is None else fused
         # each token directly reads off the logits for the next token from a lookup table
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head) for _ in range(n_layer)])
+        self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head, fused=self.fused_attention) for _ in range(n_layer)])
         self.ln_f = nn.LayerNorm(n_embd)
         self.lm_head = nn.Linear(n_embd, vocab_size)
+        self.register_load_state_dict_pre_hook(drop_tril_buffers)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, start_pos=0, positions=None, attn_mask=None):
         B, T = idx.shape
 
         # idx and target are both (B,T), tensors of integers
+        # with a kv_cache, idx only holds the new tokens and start_pos is the position of the first one
+        # positions (B,T) and attn_mask (B,T,S) (True = may attend) replace them for padded batches of prompts
         tok_embd = self.token_embedding_table(idx) #(B,T,C) = batch (4) * time (8) * channel (n_embd)
-        pos_embd = self.position_embedding_table(torch.arange(T, device=device)) # (T,C)
+        if positions is None:
+            positions = masks.positions(start_pos, T, idx.device)
+        pos_embd = self.position_embedding_table(positions) # (T,C) or (B,T,C)
         x = tok_embd + pos_embd # (B,T,C)
-        x = self.blocks(x)
+        if kv_cache is None and attn_mask is None:
+            if activation_checkpointing and self.training:
+                # less memory for one more forward of every block during backward
+                for block in self.blocks:
+                    x = torch.utils.checkpoint.checkpoint(block, x, use_reentrant=False)
+            else:
+                x = self.blocks(x)
+        else:
+            for i, block in enumerate(self.blocks):
+                x = block(x, kv_cache[i] if kv_cache is not None else None, attn_mask)
         x = self.ln_f(x)
         logits = self.lm_head(x) # (B,T,vocab_size) C is vocab_size here
 
@@ -176,51 +516,208 @@ class BigramLanguageModel(nn.Module):
         else:
             B, T, C = logits.shape
             logits = logits.view(B*T, C)
-            targets = targets.view(B*T)
+            targets = targets.reshape(B*T) # y is a strided view of the batch window
             loss = F.cross_entropy(logits, targets) #Pytorch expect (B,C,T)
         return logits, loss
 
-    def generate(self, idx, max_new_tokens):
-        # idx is (B,T) array of indices in the current context
+    def new_kv_cache(self, static=False):
+        return [block.sa.new_kv_cache(static) for block in self.blocks]
+
+    def static_forward(self, idx, kv_cache, start_pos):
+        # forward with a static kv_cache: the tokens attend to the whole cache, except the slots after them
+        # start_pos is a (1,) tensor, so a compiled decode step gets the same kind of inputs at every position
+        T = idx.shape[1]
+        positions = start_pos + masks.positions(0, T, idx.device) # (T,)
+        attn_mask = masks.positions(0, block_size, idx.device)[None, :] <= positions[:, None] # (T,block_size)
+        return self(idx, kv_cache=kv_cache, positions=positions, attn_mask=attn_mask[None])
+
+    @staticmethod
+    def select_kv_cache(kv_cache, rows):
+        for cache in kv_cache:
+            for c in (cache if isinstance(cache, list) else [cache]):
+                c.select(rows)
+
+    @staticmethod
+    def truncate_kv_cache(kv_cache, size):
+        for cache in kv_cache:
+            for c in (cache if isinstance(cache, list) else [cache]):
+                c.truncate(size)
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, use_cache=True):
+        # the tokens of generate one at a time: yields every new (B,1) token as soon as it is sampled
+        kv_cache = None
+        # the compiled decode step needs the static shapes of a static cache
+        static = compile_model and use_cache
         for _ in range(max_new_tokens):
-            # crop idx to the last block_size tokens
-            idx_cond = idx[:, -block_size:]
-            # get the predictions
-            logits, loss = self(idx_cond)
-            # focus only on the last time step
-            logits = logits[:, -1, :] # becomes (B, C)
+            # autocast around the forward only, the caller runs between two tokens and must not be inside it
+            with autocast():
+                if use_cache and kv_cache is None and idx.shape[1] < block_size:
+                    # first step: run the whole prompt once and keep its keys/values
+                    kv_cache = self.new_kv_cache(static)
+                    if static:
+                        # the prompt length changes from call to call, it stays eager
+                        start_pos = torch.zeros(1, dtype=torch.long, device=idx.device)
+                        logits, loss = self.static_forward(idx, kv_cache, start_pos)
+                    else:
+                        logits, loss = self(idx, kv_cache=kv_cache)
+                elif kv_cache is not None and idx.shape[1] <= block_size:
+                    # only the newest token goes through the model, it attends to the cached positions
+                    if static:
+                        start_pos = torch.full((1,), idx.shape[1]-1, device=idx.device)
+                        # idx_next, not a slice of idx: its stride grows every step, a recompile each time
+                        logits, loss = compiled_static_forward(self, idx_next, kv_cache, start_pos)
+                    else:
+                        logits, loss = self(idx[:, -1:], kv_cache=kv_cache, start_pos=idx.shape[1]-1)
+                else:
+                    # the context no longer fits in block_size: slide the window, which shifts every
+                    # position embedding, so the cache is stale and the last block_size tokens are recomputed
+                    kv_cache = None
+                    # crop idx to the last block_size tokens
+                    idx_cond = idx[:, -block_size:]
+                    # get the predictions
+                    logits, loss = self(idx_cond)
+            # focus only on the last time step, sample in fp32 even when the forward ran in bf16
+            logits = logits[:, -1, :].float() # becomes (B, C)
             # apply softmax to get probabilities
             probs = F.softmax(logits, dim=1) # (B, C)
             # sample from the distribution
             idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
             # append sampled index to the running sequence
             idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)  
-        return idx
+            yield idx_next
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, use_cache=True):
+        # idx is (B,T) array of indices in the current context
+        return torch.cat([idx, *self.generate_stream(idx, max_new_tokens, use_cache)], dim=1)
     
-model = BigramLanguageModel(vocab_size)
-m = model.to(device)
-
-# create a pytorch optimizer
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
-
-for iter in range(max_iters):
-    # every once in a while evaluate the loss on train and val sets
-    if iter % eval_interval == 0:
-        losses = estimate_loss()
-        print(f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f} ")
-
-    # sample a batch of data
-    xb, yb = get_batch('train')
-
-    # evaluate the loss
-    logits, loss = model(xb, yb)
-    optimizer.zero_grad(set_to_none=True)
-    loss.backward()
-    optimizer.step()
-
-# generate from the model
-context = torch.zeros((1, 1), dtype=torch.long, device=device)
-"""print(s.decode(m.generate(context, max_new_tokens=500)[0].tolist()))"""
-print(decode(m.generate(context, max_new_tokens=500)[0].tolist()))
+compiled_static_forward = compiled(BigramLanguageModel.static_forward)
+
+def load_model(path):
+    # model saved in a training checkpoint, the hyperparameters above must match its config
+    state = load_checkpoint(path)
+    model = BigramLanguageModel(state['config']['vocab_size'], n_layer=state['config']['n_layer'])
+    weights = state['model']
+    if model.fused_attention and not state['config'].get('fused_attention', False):
+        weights = fuse_attention_weights(weights)
+    model.load_state_dict(weights)
+    return model.to(device)
+
+if __name__ == '__main__':
+    if 'RANK' in os.environ: # started by torch.distributed.run
+        init_distributed(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+    master = ddp_rank == 0 # only the first process evaluates, saves checkpoints and prints
+
+    m = BigramLanguageModel(vocab_size).to(device)
+    # every process starts from the same weights (same seed), DDP averages the gradients in backward
+    model = m
+    if ddp_world_size > 1:
+        model = DDP(m, broadcast_buffers=False)
+        torch.manual_seed(1337 + ddp_rank) # different dropout masks in every process
+
+    # create a pytorch optimizer
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+
+    start_iter = 0
+    batches_state = None
+    checkpoint = latest_checkpoint(checkpoint_dir) if resume else None
+    if checkpoint is not None:
+        state = load_checkpoint(checkpoint)
+        if len(state['rng']) != ddp_world_size:
+            raise ValueError(f"{checkpoint} was saved by {len(state['rng'])} processes, not {ddp_world_size}")
+        m.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        rng = state['rng'][ddp_rank]
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None:
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        batches_state = rng['batches']
+        start_iter = state['iter']
+        if master:
+            print(f"resuming from {checkpoint} at step {start_iter}")
+    checkpoints = CheckpointWriter(checkpoint_dir) if checkpoint_interval and master else None
+
+    train_batches = BatchPrefetcher('train', seed=1337 + ddp_rank, generator_state=batches_state) if prefetch_batches else None
+    # evaluation uses the bare model: a forward of the DDP wrapper in one process only could wait for the others
+    eval_model = copy.deepcopy(m) if eval_in_background else None
+    eval_thread = None
+    # the train step goes through the compiled model, eval and generate use m
+    train_forward = compiled(model)
+    profiler = None
+    if profile_steps and master:
+        profiler = LayerProfiler(m, (Block, MultiHeadAttention, Head, FusedMultiHeadAttention, FeedForward))
+
+    for iter in range(start_iter, max_iters):
+        # every once in a while evaluate the loss on train and val sets
+        if iter % eval_interval == 0 and master:
+            if eval_model is None:
+                report_loss(m, iter)
+            else:
+                # snapshot the weights of this step, the thread evaluates them while the next steps train
+                if eval_thread is not None:
+                    eval_thread.join()
+                eval_model.load_state_dict(m.state_dict())
+                eval_thread = threading.Thread(target=report_loss, args=(eval_model, iter))
+                eval_thread.start()
+
+        profiling = profiler.step(iter) if profiler is not None else contextlib.nullcontext()
+        with profiling:
+            optimizer.zero_grad(set_to_none=True)
+            for micro_step in range(gradient_accumulation_steps):
+                # sample a batch of data
+                xb, yb = train_batches.next() if train_batches is not None else get_batch('train')
+
+                # evaluate the loss, scaled so the summed gradients are the ones of the mean over all the micro-batches
+                last = micro_step == gradient_accumulation_steps - 1
+                # DDP only has to all-reduce the gradients after the last micro-batch
+                with (model.no_sync() if ddp_world_size > 1 and not last else contextlib.nullcontext()), autocast():
+                    logits, loss = train_forward(xb, yb)
+                    loss = loss / gradient_accumulation_steps
+                loss.backward()
+            optimizer.step()
+        if profiler is not None and iter + 1 == min(start_iter + profile_steps, max_iters):
+            profiler.close()
+            profiler.save(profile_file)
+            print(profiler.table())
+            profiler = None
+
+        if checkpoint_interval and (iter + 1) % checkpoint_interval == 0:
+            # everything needed to continue at iter + 1 exactly as if the run had not stopped
+            rng = {
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                # the global rng draws the batches when they are not prefetched
+                'batches': train_batches.generator_state if train_batches is not None else None,
+            }
+            # the rng states of every process, in rank order
+            rngs = [rng]
+            if ddp_world_size > 1:
+                rngs = [None] * ddp_world_size
+                dist.all_gather_object(rngs, rng)
+            if checkpoints is not None:
+                checkpoints.save(iter + 1, {
+                    'iter': iter + 1,
+                    'model': m.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'rng': rngs,
+                    'config': {'vocab_size': vocab_size, 'block_size': block_size, 'n_embd': n_embd, 'n_head': n_head,
+                               'n_layer': n_layer, 'fused_attention': fused_attention},
+                })
+
+    if checkpoints is not None:
+        checkpoints.wait()
+    if train_batches is not None:
+        train_batches.close()
+    if eval_thread is not None:
+        eval_thread.join()
+    if ddp_world_size > 1:
+        dist.destroy_process_group()
+
+    # generate from the model
+    if master:
+        # start from a newline (token 0 of the characters, the user-defined newline symbol of the subwords)
+        context = torch.tensor(encode('\n'), dtype=torch.long, device=device)[None]
+        print(decode(m.generate(context, max_new_tokens=500)[0].tolist()))
 
 
@@ -0,0 +1,77 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Checkpoints of the bigram.py training, written atomically by a background thread
+# =======================================================
+
+import glob
+import os
+import re
+import threading
+
+import torch
+
+
+def snapshot(obj):
+    # copy of a (nested) state dict on the cpu, taken before the next optimizer step changes the tensors
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def checkpoint_path(checkpoint_dir, iter):
+    return os.path.join(checkpoint_dir, f'ckpt_{iter:07d}.pt')
+
+
+def list_checkpoints(checkpoint_dir):
+    # oldest first, ordered by iteration
+    paths = glob.glob(os.path.join(checkpoint_dir, 'ckpt_*.pt'))
+    return sorted(p for p in paths if re.fullmatch(r'ckpt_\d+\.pt', os.path.basename(p)))
+
+
+def latest_checkpoint(checkpoint_dir):
+    paths = list_checkpoints(checkpoint_dir)
+    return paths[-1] if paths else None
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter:
+    """ saves checkpoints in a background thread so the train loop only pays for the copy to the cpu """
+
+    def __init__(self, checkpoint_dir, keep=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.thread = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, iter, state):
+        # state is snapshotted now, then written while the training goes on
+        state = snapshot(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(iter, state))
+        self.thread.start()
+
+    def _write(self, iter, state):
+        path = checkpoint_path(self.checkpoint_dir, iter)
+        # write to a temporary file then rename it: a crash while saving never leaves a truncated checkpoint
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for old in list_checkpoints(self.checkpoint_dir)[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
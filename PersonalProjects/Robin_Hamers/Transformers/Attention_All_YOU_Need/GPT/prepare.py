@@ -0,0 +1,211 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: One-time preprocessing of a text corpus for bigram.py : python prepare.py input.txt
+# The text is read by chunks and the tokens are written to binary files, so bigram.py can memory-map
+# them instead of keeping the whole corpus (8 bytes per token as torch.long) in RAM.
+# python prepare.py input.txt --spm 5000 : SentencePiece subwords instead of characters
+# =======================================================
+
+import argparse
+import functools
+import glob
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from tokenizer import CharTokenizer, SentencePieceTokenizer
+
+chunk_size = 1 << 24 # characters read at once, the corpus itself never has to fit in memory
+train_split = 0.9
+
+
+def data_paths(path, key=None):
+    # input.txt -> input.train.bin, input.val.bin, input.meta.pkl, or input.<key>.train.bin ...
+    stem = os.path.splitext(path)[0]
+    if key is not None:
+        stem = f'{stem}.{key}'
+    return f'{stem}.train.bin', f'{stem}.val.bin', f'{stem}.meta.pkl'
+
+
+def input_key(path):
+    # names every file made from the corpus after its size and modification time: finding them reads none of the
+    # text, and an edited or replaced corpus gets new ones. Computed once per process and passed to the functions below
+    st = os.stat(path)
+    return hashlib.sha256(f'{st.st_size}.{st.st_mtime_ns}'.encode()).hexdigest()[:16]
+
+
+@functools.lru_cache
+def input_hash(path, key):
+    # sha256 of the text, only read when the files of key have to be made; it is kept in their meta file, so
+    # a text that only got a new modification time (touch, copy) takes back the files made from it, see cached_meta
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def corpus_paths(path, key, tokenizer=None):
+    # the files of the encoded corpus: input.<key>.train.bin ..., with subwords
+    # input.<key>.<model hash>.train.bin ... (the same text encoded by another model is another corpus)
+    if tokenizer is not None:
+        key = f'{key}.{tokenizer.hash[:16]}'
+    return data_paths(path, key)
+
+
+def cached_meta(path, exclude=None, **fields):
+    # (meta file, meta) of a corpus made earlier from path with these meta fields, ex: input_hash, or (None, None)
+    for meta_path in glob.glob(f'{glob.escape(os.path.splitext(path)[0])}.*.meta.pkl'):
+        if meta_path == exclude:
+            continue
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+        if all(meta.get(name) == value for name, value in fields.items()):
+            return meta_path, meta
+    return None, None
+
+
+def move_corpus(old_meta_path, meta_path, meta):
+    # the files of an old key renamed to a new one; the old meta goes first and the new one is written last,
+    # so an interrupted move leaves no meta file pointing at missing tokens
+    old, new = old_meta_path[:-len('.meta.pkl')], meta_path[:-len('.meta.pkl')]
+    os.remove(old_meta_path)
+    for ext in ('.train.bin', '.val.bin'):
+        os.replace(old + ext, new + ext)
+    with open(meta_path, 'wb') as f:
+        pickle.dump(meta, f)
+    return meta
+
+
+def read_chunks(path, whole_lines=False):
+    # whole_lines : every chunk but the last ends with a newline (a subword token never spans one)
+    rest = ''
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            read = f.read(chunk_size)
+            chunk = rest + read
+            if not read:
+                if chunk:
+                    yield chunk
+                return
+            if whole_lines:
+                cut = chunk.rfind('\n') + 1 # 0 without a newline: everything waits for the next read
+                chunk, rest = chunk[:cut], chunk[cut:]
+                if not chunk:
+                    continue
+            yield chunk
+
+
+def prepare(path, vocab_file=None, key=None):
+    # vocab_file : vocabulary saved by a previous run, reused instead of scanning the corpus (it is created if missing)
+    # key : input_key(path), if the caller already has it
+    key = key or input_key(path)
+    train_path, val_path, meta_path = corpus_paths(path, key)
+    sha = input_hash(path, key)
+    if vocab_file is None: # the ids of a corpus made with a vocabulary file can be other ones
+        old_meta_path, meta = cached_meta(path, meta_path, input_hash=sha, tokenizer=None, vocab_file=None)
+        if meta is not None:
+            print(f"{path}: same text as {old_meta_path}, its tokens are reused")
+            return move_corpus(old_meta_path, meta_path, meta)
+    tokenizer = None
+    if vocab_file is not None and os.path.exists(vocab_file):
+        tokenizer = CharTokenizer.load(vocab_file)
+
+    # first pass : vocabulary and number of tokens (one token per character)
+    n_tokens = 0
+    seen = np.zeros(0, dtype=np.int64)
+    for chunk in read_chunks(path):
+        n_tokens += len(chunk)
+        if tokenizer is None:
+            seen = np.union1d(seen, CharTokenizer.used_codepoints(chunk))
+    if tokenizer is None:
+        tokenizer = CharTokenizer(chr(c) for c in seen)
+        if vocab_file is not None:
+            tokenizer.save(vocab_file)
+    chars = tokenizer.chars
+    dtype = np.uint16 if len(chars) < 2**16 else np.uint32
+
+    # second pass : encode and write, the first 90% of the tokens go to train and the rest to val
+    n = int(train_split * n_tokens)
+    written = 0
+    with open(train_path, 'wb') as train_f, open(val_path, 'wb') as val_f:
+        for chunk in read_chunks(path):
+            tokens = tokenizer.encode(chunk, dtype=dtype)
+            cut = max(0, min(len(tokens), n - written))
+            tokens[:cut].tofile(train_f)
+            tokens[cut:].tofile(val_f)
+            written += len(tokens)
+
+    meta = {'chars': chars, 'vocab_size': len(chars), 'dtype': np.dtype(dtype).name, 'input_hash': sha,
+            'vocab_file': vocab_file}
+    with open(meta_path, 'wb') as f:
+        pickle.dump(meta, f)
+    print(f"{path}: {n_tokens} tokens, vocab size {len(chars)}, {n} train / {n_tokens - n} val as {meta['dtype']}")
+    return meta
+
+
+def subword_tokenizer(path, vocab_size, key=None):
+    # trained once on the corpus, then loaded from input.<key>.spm<vocab_size>.model
+    key = key or input_key(path)
+    prefix = f'{os.path.splitext(path)[0]}.{key}.spm{vocab_size}'
+    if not os.path.exists(prefix + '.model'):
+        # the model of a corpus made from the same text under another key is taken instead of training a new one
+        _, meta = cached_meta(path, input_hash=input_hash(path, key), tokenizer='spm', vocab_size=vocab_size)
+        if meta is None or not os.path.exists(meta['model_file']):
+            return SentencePieceTokenizer.train(path, prefix, vocab_size)
+        old_prefix = meta['model_file'][:-len('.model')]
+        if os.path.exists(old_prefix + '.vocab'):
+            os.replace(old_prefix + '.vocab', prefix + '.vocab')
+        os.replace(old_prefix + '.model', prefix + '.model')
+    return SentencePieceTokenizer(prefix + '.model')
+
+
+def prepare_subword(path, tokenizer, key=None):
+    # the files of prepare, also named after the hash of the tokenizer model, see corpus_paths
+    # the number of tokens is only known once encoded, so they all go to train, then the last 10% move to val
+    key = key or input_key(path)
+    train_path, val_path, meta_path = corpus_paths(path, key, tokenizer)
+    sha = input_hash(path, key)
+    old_meta_path, meta = cached_meta(path, meta_path, input_hash=sha, hash=tokenizer.hash)
+    if meta is not None:
+        print(f"{path}: same text and model as {old_meta_path}, its tokens are reused")
+        return move_corpus(old_meta_path, meta_path, dict(meta, model_file=tokenizer.model_file))
+    dtype = np.uint16 if tokenizer.vocab_size < 2**16 else np.uint32
+    n_chars = n_tokens = 0
+    with open(train_path, 'wb') as f:
+        for chunk in read_chunks(path, whole_lines=True):
+            tokens = tokenizer.encode(chunk, dtype=dtype)
+            tokens.tofile(f)
+            n_chars += len(chunk)
+            n_tokens += len(tokens)
+    n = int(train_split * n_tokens)
+    tail = np.memmap(train_path, dtype=dtype, mode='r')[n:]
+    tail.tofile(val_path)
+    del tail
+    os.truncate(train_path, n * np.dtype(dtype).itemsize)
+
+    # written last : a meta file means the encoded corpus is complete
+    meta = {'tokenizer': 'spm', 'model_file': tokenizer.model_file, 'hash': tokenizer.hash,
+            'vocab_size': tokenizer.vocab_size, 'dtype': np.dtype(dtype).name, 'input_hash': sha}
+    with open(meta_path, 'wb') as f:
+        pickle.dump(meta, f)
+    print(f"{path}: {n_chars} characters -> {n_tokens} tokens ({n_chars / n_tokens:.2f} characters per token), "
+          f"vocab size {tokenizer.vocab_size}, {n} train / {n_tokens - n} val as {meta['dtype']}")
+    return meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tokenize a text corpus for bigram.py')
+    parser.add_argument('input', nargs='?', default='input.txt')
+    parser.add_argument('--vocab', help='vocabulary json file to reuse, or to create for the next runs')
+    parser.add_argument('--spm', type=int, metavar='VOCAB_SIZE', help='SentencePiece subwords with this vocabulary size')
+    args = parser.parse_args()
+    key = input_key(args.input)
+    if args.spm:
+        prepare_subword(args.input, subword_tokenizer(args.input, args.spm, key), key)
+    else:
+        prepare(args.input, args.vocab, key)
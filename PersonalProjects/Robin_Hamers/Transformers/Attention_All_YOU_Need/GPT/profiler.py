@@ -0,0 +1,164 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Per-module profiling of the training steps : forward and backward wall time of every Block,
+# attention and FeedForward, their flops and the tensors they allocate, saved as a json summary and a chrome trace
+# =======================================================
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from torch.utils.flop_counter import flop_registry
+from torch.utils.module_tracker import ModuleTracker
+
+
+class OpCounter(TorchDispatchMode):
+    """ flops and new tensors of every aten op, charged to all the modules running it, in forward or backward """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self.tracker = ModuleTracker()
+        self.counts = defaultdict(lambda: {'flops': 0, 'allocations': 0, 'allocated_bytes': 0}) # (module, phase)
+
+    def __enter__(self):
+        self.tracker.__enter__()
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.tracker.__exit__(*args)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        packet = func._overloadpacket
+        flops = flop_registry[packet](*args, **kwargs, out_val=out) if packet in flop_registry else 0
+        # an output allocates when its storage is not the one of an input (views and in-place ops don't)
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        new = {}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                new[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        phase = 'backward' if self.tracker.is_bw else 'forward'
+        for name in self.tracker.parents:
+            # under DDP the tracker names the modules from the wrapper
+            counts = self.counts[name.replace('DistributedDataParallel.module', self.root, 1), phase]
+            counts['flops'] += flops
+            counts['allocations'] += len(new)
+            counts['allocated_bytes'] += sum(new.values())
+        return out
+
+
+class LayerProfiler:
+    """ times the forward and backward of the modules of `module_types` during the steps run in step()
+
+    The hooks only exist while the profiler is attached: close() removes them, a model that is not profiled
+    runs exactly as before. The flops and allocations are counted on the first step only, they are the same
+    every step and the dispatch mode counting them slows that step down, so it is left out of the times. """
+
+    def __init__(self, model, module_types):
+        self.root = type(model).__name__
+        self.synchronize = next(model.parameters()).is_cuda # wait for the kernels, or the times are launch times
+        self.events = [] # (module, phase, step, start, duration)
+        self.counts = {}
+        self.counted_step = None
+        self.current_step = None
+        self.starts = {}
+        self.origin = time.perf_counter()
+        self.handles = []
+        for name, module in model.named_modules():
+            if isinstance(module, module_types):
+                name = f"{self.root}.{name}"
+                self.handles += [
+                    module.register_forward_pre_hook(self._start(name, 'forward')),
+                    module.register_forward_hook(self._stop(name, 'forward')),
+                    module.register_full_backward_pre_hook(self._start(name, 'backward')),
+                    module.register_full_backward_hook(self._stop(name, 'backward')),
+                ]
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter() - self.origin
+
+    def _start(self, name, phase):
+        def hook(*args):
+            if self.current_step is not None:
+                self.starts[name, phase] = self._now()
+        return hook
+
+    def _stop(self, name, phase):
+        def hook(*args):
+            if self.current_step is not None and (name, phase) in self.starts:
+                start = self.starts.pop((name, phase))
+                self.events.append((name, phase, self.current_step, start, self._now() - start))
+        return hook
+
+    @contextlib.contextmanager
+    def step(self, index):
+        # with activation checkpointing the forwards recomputed in backward are counted in the forward time
+        counter = OpCounter(self.root) if self.counted_step is None else contextlib.nullcontext()
+        self.current_step = index
+        start = self._now()
+        try:
+            with counter:
+                yield
+        finally:
+            self.events.append(('step', 'step', index, start, self._now() - start))
+            self.current_step = None
+        if self.counted_step is None:
+            self.counted_step = index
+            self.counts = dict(counter.counts)
+
+    def close(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def summary(self):
+        # mean ms per step of every module and the counts of one step
+        steps = {step for _, _, step, _, _ in self.events}
+        timed = steps - {self.counted_step} or steps
+        modules = defaultdict(lambda: {'forward_ms': 0.0, 'backward_ms': 0.0})
+        for name, phase, step, _, duration in self.events:
+            if step in timed:
+                key = 'step_ms' if phase == 'step' else f"{phase}_ms"
+                modules[name][key] = modules[name].get(key, 0.0) + duration * 1e3 / len(timed)
+        step_ms = modules.pop('step', {}).get('step_ms', 0.0)
+        for (name, phase), counts in self.counts.items():
+            if name in modules:
+                for key, value in counts.items():
+                    modules[name][f"{phase}_{key}"] = value
+        return {'timed_steps': len(timed), 'step_ms': step_ms, 'modules': dict(modules)}
+
+    def table(self):
+        summary = self.summary()
+        lines = [f"{'module':<40} | {'fwd ms':>8} | {'bwd ms':>8} | {'fwd GFLOP':>9} | {'bwd GFLOP':>9} | {'fwd allocs':>10} | {'fwd MB':>8}"]
+        for name, row in summary['modules'].items():
+            lines.append(f"{name:<40} | {row['forward_ms']:>8.2f} | {row['backward_ms']:>8.2f} | "
+                         f"{row.get('forward_flops', 0) / 1e9:>9.3f} | {row.get('backward_flops', 0) / 1e9:>9.3f} | "
+                         f"{row.get('forward_allocations', 0):>10} | {row.get('forward_allocated_bytes', 0) / 2**20:>8.1f}")
+        lines.append(f"mean step: {summary['step_ms']:.1f} ms over {summary['timed_steps']} steps")
+        return '\n'.join(lines)
+
+    def save(self, path):
+        # path.json: the summary, path.trace.json: every event, open it in chrome://tracing or ui.perfetto.dev
+        with open(f"{path}.json", 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        threads = {'step': 0, 'forward': 0, 'backward': 1}
+        trace = [
+            {'ph': 'M', 'name': 'thread_name', 'pid': 0, 'tid': 0, 'args': {'name': 'step / forward'}},
+            {'ph': 'M', 'name': 'thread_name', 'pid': 0, 'tid': 1, 'args': {'name': 'backward'}},
+        ]
+        for name, phase, step, start, duration in self.events:
+            trace.append({'name': name, 'cat': phase, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                          'pid': 0, 'tid': threads[phase], 'args': {'step': step}})
+        with open(f"{path}.trace.json", 'w') as f:
+            json.dump({'traceEvents': trace}, f)
@@ -0,0 +1,94 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: int8 dynamic quantization of a trained BigramLanguageModel for cpu inference :
+# python quantize.py [checkpoint] --out model_int8.pt
+# =======================================================
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+import bigram
+from bigram import BigramLanguageModel, checkpoint_dir, estimate_loss, latest_checkpoint, load_checkpoint, load_model
+
+
+def quantize(model):
+    # the weights of every nn.Linear (attention projections, FeedForward, lm_head) become int8,
+    # the activations are quantized on the fly at each call; embeddings and layer norms stay fp32
+    return quantize_dynamic(model.to('cpu').eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized(path):
+    # a model exported by this script: quantize an empty model to get the same modules, then load the weights
+    # the modules are the ones of the export (layers, attention layout), not the ones of the globals of bigram.py
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    config = state['config']
+    model = quantize(BigramLanguageModel(config['vocab_size'], n_layer=config['n_layer'],
+                                         fused=config['fused_attention']))
+    model.load_state_dict(state['model'])
+    return model
+
+
+def file_size(model):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.pt')
+        torch.save(model.state_dict(), path)
+        return os.path.getsize(path)
+
+
+def tokens_per_sec(model, max_new_tokens):
+    model.eval()
+    context = torch.zeros((1, 1), dtype=torch.long)
+    start = time.perf_counter()
+    model.generate(context, max_new_tokens=max_new_tokens)
+    return max_new_tokens / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quantize a checkpoint to int8, check its perplexity and export it')
+    parser.add_argument('checkpoint', nargs='?', help='training checkpoint (default: the latest one)')
+    parser.add_argument('--out', default='model_int8.pt')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='accepted relative increase of the val perplexity')
+    parser.add_argument('--tokens', type=int, default=200, help='tokens generated to measure the speed')
+    parser.add_argument('--eval-iters', type=int, default=bigram.eval_iters, help='batches of the fixed eval set')
+    args = parser.parse_args()
+
+    path = args.checkpoint or latest_checkpoint(checkpoint_dir)
+    if path is None:
+        sys.exit(f"no checkpoint given and none in {checkpoint_dir}")
+    # quantized kernels run in fp32 around the int8 matmuls, not under the bf16 autocast; and on the cpu
+    bigram.precision = 'fp32'
+    bigram.device = 'cpu'
+    bigram.eval_iters = args.eval_iters
+
+    model = load_model(path).to('cpu')
+    # the attention layout of the model load_model built, whatever the checkpoint was trained with
+    config = dict(load_checkpoint(path)['config'], fused_attention=model.fused_attention)
+    ppl = math.exp(estimate_loss(model)['val'])
+    speed = tokens_per_sec(model, args.tokens)
+    size = file_size(model)
+
+    qmodel = quantize(model)
+    q_ppl = math.exp(estimate_loss(qmodel)['val'])
+    q_speed = tokens_per_sec(qmodel, args.tokens)
+    q_size = file_size(qmodel)
+
+    print(f"{path} ({bigram.eval_iters * bigram.batch_size} val windows, {args.tokens} generated tokens)")
+    print(f"{'':>5} | {'val perplexity':>14} | {'generate tok/s':>14} | {'size MB':>7}")
+    print(f"{'fp32':>5} | {ppl:>14.4f} | {speed:>14.1f} | {size / 2**20:>7.2f}")
+    print(f"{'int8':>5} | {q_ppl:>14.4f} | {q_speed:>14.1f} | {q_size / 2**20:>7.2f}")
+
+    increase = q_ppl / ppl - 1
+    if increase > args.tolerance:
+        sys.exit(f"perplexity up by {increase:.2%}, more than the {args.tolerance:.2%} tolerance: not exported")
+    torch.save({'config': config, 'model': qmodel.state_dict(), 'quantization': 'int8 dynamic'}, args.out)
+    print(f"perplexity up by {increase:.2%} (tolerance {args.tolerance:.2%}), exported to {args.out}")
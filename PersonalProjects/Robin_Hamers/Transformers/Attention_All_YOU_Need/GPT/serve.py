@@ -0,0 +1,253 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Serve many sampling requests from one BigramLanguageModel : prompts that arrive together are
+# left-padded into one batch and decoded together with the kv cache, each with its own sampling settings.
+# stream_text / astream_text give the text of one prompt while it is sampled : python serve.py --stream 'ROMEO:'
+# =======================================================
+
+import argparse
+import asyncio
+import time
+
+import torch
+from torch.nn import functional as F
+
+from bigram import (BigramLanguageModel, autocast, block_size, checkpoint_dir, decode, device, encode,
+                    latest_checkpoint, load_model, masks, vocab_size)
+
+
+def stream_text(model, prompt, max_new_tokens=100, use_cache=True):
+    # the continuation of prompt, yielded piece by piece as the tokens are sampled (with the kv cache of generate)
+    # an empty prompt starts from a newline, like bigram.py
+    idx = torch.tensor([list(encode(prompt)) or list(encode('\n'))], dtype=torch.long, device=device)
+    pending = [] # tokens not yielded yet, only decoded again until they make whole characters
+    for idx_next in model.generate_stream(idx, max_new_tokens, use_cache):
+        pending.append(idx_next.item())
+        text = decode(pending)
+        # a subword can stop in the middle of a utf-8 character (byte fallback): wait for the rest of it
+        if not text.endswith('\ufffd'):
+            yield text
+            pending = []
+    if pending:
+        yield decode(pending)
+
+
+async def astream_text(model, prompt, max_new_tokens=100, use_cache=True):
+    # stream_text for asyncio: every token is sampled in a thread, the event loop keeps running meanwhile
+    loop = asyncio.get_running_loop()
+    pieces = stream_text(model, prompt, max_new_tokens, use_cache)
+    done = object()
+    while True:
+        piece = await loop.run_in_executor(None, next, pieces, done)
+        if piece is done:
+            return
+        yield piece
+
+
+class GenerationRequest:
+    """ one prompt (token ids) and how to sample its continuation """
+
+    def __init__(self, prompt, max_new_tokens=100, temperature=1.0, top_k=None):
+        if not 0 < max_new_tokens < block_size:
+            raise ValueError(f"max_new_tokens must be between 1 and {block_size - 1}, got {max_new_tokens}")
+        if temperature < 0:
+            raise ValueError(f"temperature must be >= 0 (0 = greedy), got {temperature}")
+        if top_k is not None and not (isinstance(top_k, int) and top_k > 0):
+            raise ValueError(f"top_k must be a positive int (None = the whole vocabulary), got {top_k!r}")
+        # an empty prompt starts from a newline like bigram.py, a long one keeps its last tokens that fit
+        prompt = list(prompt) or encode('\n').tolist()
+        self.prompt = prompt[-(block_size - max_new_tokens):]
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+
+
+def sample(logits, temperature, top_k):
+    # logits (B,vocab_size), temperature and top_k (B,): a different setting for every row
+    greedy = logits.argmax(dim=-1)
+    logits = logits / temperature.clamp(min=1e-6)[:, None]
+    # keep the top_k largest logits of each row: threshold at the k-th largest one
+    kth = logits.sort(dim=-1, descending=True).values.gather(1, (top_k - 1)[:, None])
+    logits = logits.masked_fill(logits < kth, float('-inf'))
+    probs = F.softmax(logits, dim=-1)
+    sampled = torch.multinomial(probs, num_samples=1).squeeze(1)
+    return torch.where(temperature == 0, greedy, sampled)
+
+
+class GenerationEngine:
+    """ decodes a batch of prompts of different lengths together
+
+    The prompts are left-padded to the same length, so every new token of the batch is written in the
+    same kv cache slot. The pad slots are masked out of attention and the positions of each row start at
+    its first real token, so every row samples as if it was generated alone. """
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    @staticmethod
+    def batches(requests):
+        # consecutive groups whose longest prompt plus longest continuation fit in block_size
+        group = []
+        for request in requests:
+            longest = max([len(r.prompt) for r in group] + [len(request.prompt)])
+            most_new = max([r.max_new_tokens for r in group] + [request.max_new_tokens])
+            if group and longest + most_new > block_size:
+                yield group
+                group = []
+            group.append(request)
+        if group:
+            yield group
+
+    @torch.no_grad()
+    def generate(self, requests):
+        # returns the new token ids of every request
+        B = len(requests)
+        lengths = torch.tensor([len(r.prompt) for r in requests], device=device)
+        L = int(lengths.max())
+        pad = L - lengths # (B,)
+        idx = torch.zeros((B, L), dtype=torch.long, device=device)
+        for row, r in enumerate(requests):
+            idx[row, L - len(r.prompt):] = torch.tensor(r.prompt, device=device)
+
+        slots = masks.positions(0, L, device)
+        positions = (slots[None, :] - pad[:, None]).clamp(min=0) # (B,L)
+        valid = slots[None, :] >= pad[:, None] # (B,L) keys that are real tokens
+        # causal, without the pad keys; a pad query still sees itself so its softmax has something to normalize
+        causal = masks.causal(L, L, device)
+        mask = causal[None] & (valid[:, None, :] | torch.eye(L, dtype=torch.bool, device=device)[None]) # (B,L,L)
+
+        temperature = torch.tensor([r.temperature for r in requests], dtype=torch.float32, device=device)
+        top_k = torch.tensor([min(r.top_k or vocab_size, vocab_size) for r in requests], device=device)
+        remaining = torch.tensor([r.max_new_tokens for r in requests], device=device)
+        active = torch.arange(B, device=device) # request of every row still in the batch
+        outputs = [[] for _ in requests]
+
+        kv_cache = self.model.new_kv_cache()
+        with autocast():
+            logits, _ = self.model(idx, kv_cache=kv_cache, positions=positions, attn_mask=mask)
+            slot = L
+            while True:
+                idx_next = sample(logits[:, -1, :].float(), temperature, top_k) # (b,)
+                for r, token in zip(active.tolist(), idx_next.tolist()):
+                    outputs[r].append(token)
+                remaining -= 1
+                keep = remaining > 0
+                if not keep.any():
+                    break
+                if not keep.all():
+                    # finished requests leave the batch, their cache rows are dropped too
+                    rows = keep.nonzero().squeeze(1)
+                    self.model.select_kv_cache(kv_cache, rows)
+                    pad, valid, idx_next = pad[rows], valid[rows], idx_next[rows]
+                    temperature, top_k, remaining, active = temperature[rows], top_k[rows], remaining[rows], active[rows]
+                valid = torch.cat((valid, torch.ones_like(valid[:, :1])), dim=1)
+                logits, _ = self.model(idx_next[:, None], kv_cache=kv_cache, positions=(slot - pad)[:, None],
+                                       attn_mask=valid[:, None, :])
+                slot += 1
+        return outputs
+
+
+class GenerationServer:
+    """ asyncio front end: the requests that arrive within `window` seconds are decoded as one batch """
+
+    def __init__(self, engine, window=0.01, max_batch_size=32):
+        self.engine = engine
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+
+    async def generate(self, prompt, max_new_tokens=100, temperature=1.0, top_k=None):
+        # text in, text out
+        request = GenerationRequest(encode(prompt).tolist(), max_new_tokens, temperature, top_k)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return decode(await future)
+
+    async def _collect(self):
+        # wait for a first request, then take what arrives during the window
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            futures = {id(request): future for request, future in batch}
+            # a client that stopped waiting (cancelled, wait_for timeout) has a done future: its request is dropped,
+            # and it can also stop waiting while its group is decoded, so every future is checked before it is set
+            pending = [request for request, future in batch if not future.done()]
+            for group in self.engine.batches(pending):
+                try:
+                    # the decoding runs in a thread, the event loop keeps accepting requests meanwhile
+                    outputs = await loop.run_in_executor(None, self.engine.generate, group)
+                except Exception as e:
+                    # only this group fails, the worker goes on with the next ones
+                    for request in group:
+                        if not futures[id(request)].done():
+                            futures[id(request)].set_exception(e)
+                    continue
+                for request, output in zip(group, outputs):
+                    if not futures[id(request)].done():
+                        futures[id(request)].set_result(output)
+
+
+async def stream_demo(model, prompt, max_new_tokens):
+    start = time.perf_counter()
+    first = None
+    print(prompt, end='', flush=True)
+    async for piece in astream_text(model, prompt, max_new_tokens):
+        if first is None:
+            first = time.perf_counter() - start
+        print(piece, end='', flush=True)
+    elapsed = time.perf_counter() - start
+    print(f"\n\nfirst piece after {first * 1000:.1f} ms, {max_new_tokens} tokens in {elapsed:.2f} s")
+
+
+async def demo(engine, prompts, max_new_tokens):
+    server = GenerationServer(engine)
+    worker = asyncio.create_task(server.serve_forever())
+    start = time.perf_counter()
+    texts = await asyncio.gather(*[
+        server.generate(prompt, max_new_tokens=max_new_tokens, temperature=0.8 + 0.1 * (i % 3), top_k=None if i % 2 else 20)
+        for i, prompt in enumerate(prompts)
+    ])
+    elapsed = time.perf_counter() - start
+    worker.cancel()
+    for prompt, text in zip(prompts, texts):
+        print(f"--- {prompt!r}\n{prompt}{text}")
+    start = time.perf_counter()
+    for prompt in prompts:
+        engine.generate([GenerationRequest(encode(prompt).tolist(), max_new_tokens)])
+    one_by_one = time.perf_counter() - start
+    tokens = len(prompts) * max_new_tokens
+    print(f"\n{len(prompts)} requests: {tokens / elapsed:.1f} tokens/s batched, {tokens / one_by_one:.1f} tokens/s one by one")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sample many prompts at once from the latest checkpoint')
+    parser.add_argument('prompts', nargs='*', default=['ROMEO:', 'First Citizen:\nWe are', 'KING', 'O, ', 'JULIET:\nAy me'])
+    parser.add_argument('--max-new-tokens', type=int, default=100)
+    parser.add_argument('--stream', action='store_true', help='print the text of the first prompt while it is sampled')
+    args = parser.parse_args()
+
+    checkpoint = latest_checkpoint(checkpoint_dir)
+    if checkpoint is None:
+        print(f"no checkpoint in {checkpoint_dir}, sampling from an untrained model")
+        model = BigramLanguageModel(vocab_size).to(device)
+    else:
+        model = load_model(checkpoint)
+    if args.stream:
+        asyncio.run(stream_demo(model.eval(), args.prompts[0], args.max_new_tokens))
+    else:
+        asyncio.run(demo(GenerationEngine(model), args.prompts, args.max_new_tokens))
@@ -0,0 +1,126 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Speculative decoding : a small draft BigramLanguageModel proposes k tokens, the main model checks
+# them all in one forward and keeps a prefix of them, with the same distribution as sampling the main model alone
+# python speculative.py --draft checkpoints_draft/ckpt_0005000.pt
+# (the draft is trained by bigram.py with n_layer = 1 and another checkpoint_dir)
+# =======================================================
+
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from bigram import autocast, block_size, checkpoint_dir, decode, device, encode, latest_checkpoint, load_model
+
+
+@torch.no_grad()
+def speculative_generate(model, draft, idx, max_new_tokens, k=4):
+    # idx is a (1,T) context, returns it with max_new_tokens more and the number of drafts proposed/accepted
+    if idx.shape[0] != 1:
+        raise ValueError(f"one sequence at a time, every sequence accepts a different number of drafts, got {idx.shape[0]}")
+    if idx.shape[1] + max_new_tokens > block_size:
+        raise ValueError(f"the context and the new tokens must fit in block_size ({block_size})")
+    model_cache, draft_cache = model.new_kv_cache(), draft.new_kv_cache()
+    model_len = draft_len = 0 # tokens of idx in each cache
+    end = idx.shape[1] + max_new_tokens
+    stats = {'proposed': 0, 'accepted': 0, 'forwards': 0}
+    with autocast():
+        while idx.shape[1] < end:
+            T = idx.shape[1]
+            n = min(k, end - T - 1) # n drafts and the token the main model adds after them
+            # the draft samples n tokens, one by one, feeding only the tokens not in its cache yet
+            drafts, qs = idx, []
+            for _ in range(n):
+                logits, _ = draft(drafts[:, draft_len:], kv_cache=draft_cache, start_pos=draft_len)
+                draft_len = drafts.shape[1]
+                q = F.softmax(logits[0, -1, :].float(), dim=-1)
+                drafts = torch.cat((drafts, torch.multinomial(q, num_samples=1)[None]), dim=1)
+                qs.append(q)
+            # one forward of the main model over the drafts: p[i] is its distribution for the token T+i
+            logits, _ = model(drafts[:, model_len:], kv_cache=model_cache, start_pos=model_len)
+            model_len = drafts.shape[1]
+            p = F.softmax(logits[0, -(n+1):, :].float(), dim=-1) # (n+1,vocab_size)
+
+            # keep draft i with probability min(1, p/q); at the first rejection sample from the part of p
+            # above q instead, which makes every kept token distributed as p
+            new = []
+            for i in range(n):
+                token = drafts[0, T+i]
+                if torch.rand(()) < p[i, token] / qs[i][token]:
+                    new.append(token)
+                    continue
+                residual = (p[i] - qs[i]).clamp(min=0)
+                new.append(torch.multinomial(residual / residual.sum(), num_samples=1)[0])
+                break
+            else:
+                # every draft kept: the last distribution of the main model gives one more token for free
+                new.append(torch.multinomial(p[n], num_samples=1)[0])
+            stats['proposed'] += n
+            stats['accepted'] += len(new) - 1
+            stats['forwards'] += 1
+            idx = torch.cat((idx, torch.stack(new)[None]), dim=1)
+
+            # the caches forget the rejected drafts, the last new token is fed in the next round
+            model_len, draft_len = min(model_len, idx.shape[1]-1), min(draft_len, idx.shape[1]-1)
+            model.truncate_kv_cache(model_cache, model_len)
+            draft.truncate_kv_cache(draft_cache, draft_len)
+    return idx, stats
+
+
+def total_variation(a, b, vocab_size):
+    # distance between the empirical distributions of two samples of tokens, 0 = the same
+    pa = torch.bincount(a, minlength=vocab_size).float() / len(a)
+    pb = torch.bincount(b, minlength=vocab_size).float() / len(b)
+    return 0.5 * (pa - pb).abs().sum().item()
+
+
+def compare_samples(model, draft, context, new_tokens, samples, k):
+    # the tokens at every new position, sampled many times by generate and by speculative_generate;
+    # the distance generate/speculative should be as small as generate/generate (the sampling noise)
+    vocab_size = model.lm_head.out_features
+    runs = {'generate': [], 'generate again': [], 'speculative': []}
+    for _ in range(samples):
+        runs['generate'].append(model.generate(context, new_tokens)[0, -new_tokens:])
+        runs['generate again'].append(model.generate(context, new_tokens)[0, -new_tokens:])
+        runs['speculative'].append(speculative_generate(model, draft, context, new_tokens, k)[0][0, -new_tokens:])
+    runs = {name: torch.stack(tokens) for name, tokens in runs.items()} # (samples,new_tokens)
+    print(f"total variation distance of the sampled tokens, {samples} samples per position")
+    print(f"{'position':>8} | {'generate / generate':>19} | {'generate / speculative':>22}")
+    for position in range(new_tokens):
+        noise = total_variation(runs['generate'][:, position], runs['generate again'][:, position], vocab_size)
+        distance = total_variation(runs['generate'][:, position], runs['speculative'][:, position], vocab_size)
+        print(f"{position:>8} | {noise:>19.3f} | {distance:>22.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sample with speculative decoding and compare with generate')
+    parser.add_argument('model', nargs='?', help='checkpoint of the main model (default: the latest one)')
+    parser.add_argument('--draft', required=True, help='checkpoint of the draft model, ex: trained with n_layer = 1')
+    parser.add_argument('--k', type=int, default=4, help='tokens proposed by the draft per forward of the main model')
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=0, help='also compare the distributions with this many samples')
+    args = parser.parse_args()
+
+    model = load_model(args.model or latest_checkpoint(checkpoint_dir)).eval()
+    draft = load_model(args.draft).eval()
+    # a newline to start from, like bigram.py
+    context = torch.tensor(encode('\n'), dtype=torch.long, device=device)[None]
+
+    start = time.perf_counter()
+    model.generate(context, args.tokens)
+    t_generate = time.perf_counter() - start
+    start = time.perf_counter()
+    out, stats = speculative_generate(model, draft, context, args.tokens, args.k)
+    t_speculative = time.perf_counter() - start
+    print(decode(out[0].tolist()))
+    print(f"\n{len(draft.blocks)} layer draft, {len(model.blocks)} layer model, k = {args.k}")
+    print(f"acceptance rate {stats['accepted'] / max(stats['proposed'], 1):.1%}, "
+          f"{args.tokens / stats['forwards']:.2f} tokens per forward of the main model")
+    print(f"generate {args.tokens / t_generate:.1f} tokens/s, speculative {args.tokens / t_speculative:.1f} tokens/s, "
+          f"{t_generate / t_speculative:.2f}x")
+    if args.samples:
+        compare_samples(model, draft, context, 3, args.samples, args.k)
@@ -0,0 +1,113 @@
+# =======================================================
+# Name: Hamers Robin
+# GitHub: Rhodham96
+# Year: 2025
+# Description: Tokenizers of bigram.py : characters, encoded and decoded through NumPy lookup tables,
+# or SentencePiece subwords trained on the corpus
+# =======================================================
+
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+import sentencepiece as spm
+
+
+class CharTokenizer:
+    """ one token per character, the same ids as stoi/itos of the sorted vocabulary """
+
+    def __init__(self, chars):
+        self.chars = list(chars)
+        self.vocab_size = len(self.chars)
+        # itos as an array of unicode codepoints, stoi as an array indexed by codepoint (-1 = not in the vocabulary)
+        self.codepoints = np.array([ord(c) for c in self.chars], dtype=np.uint32)
+        self.lookup = np.full(int(self.codepoints.max()) + 1 if self.chars else 0, -1, dtype=np.int64)
+        self.lookup[self.codepoints] = np.arange(self.vocab_size)
+
+    @staticmethod
+    def to_codepoints(text):
+        # utf-32 is one fixed size word per character, so the codepoints come straight out of the bytes
+        return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+    @classmethod
+    def used_codepoints(cls, text):
+        # sorted(set(text)) as codepoints, a bincount is one linear pass where np.unique would sort the whole text
+        return np.flatnonzero(np.bincount(cls.to_codepoints(text)))
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(chr(c) for c in cls.used_codepoints(text))
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chars, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def encode(self, text, dtype=np.int64):
+        # encoder: take a string, output an array of integers
+        codepoints = self.to_codepoints(text)
+        ids = self.lookup[np.minimum(codepoints, len(self.lookup) - 1)]
+        unknown = (ids < 0) | (codepoints >= len(self.lookup))
+        if unknown.any():
+            missing = sorted(set(chr(c) for c in codepoints[unknown]))
+            raise KeyError(f"characters not in the vocabulary: {missing}")
+        return ids.astype(dtype, copy=False)
+
+    def decode(self, ids):
+        # decoder: take a list/array/tensor of integers, output a string
+        return self.codepoints[np.asarray(ids)].tobytes().decode('utf-32-le')
+
+    def decode_batch(self, sequences):
+        # many sequences at once : a single lookup and a single utf-32 decode, then the text is cut back
+        # into one string per sequence (every token is exactly one character)
+        sequences = [np.asarray(seq, dtype=np.int64).reshape(-1) for seq in sequences]
+        text = self.decode(np.concatenate(sequences)) if sequences else ''
+        ends = np.cumsum([len(seq) for seq in sequences])
+        return [text[end - len(seq):end] for seq, end in zip(sequences, ends)]
+
+
+class SentencePieceTokenizer:
+    """ subword tokens of a SentencePiece model, with the encode/decode interface of CharTokenizer """
+
+    def __init__(self, model_file):
+        self.model_file = model_file
+        self.processor = spm.SentencePieceProcessor(model_file=model_file)
+        self.vocab_size = self.processor.get_piece_size()
+        # names the files of a corpus encoded with this model, another model never reads them
+        with open(model_file, 'rb') as f:
+            self.hash = hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def train(cls, input_file, model_prefix, vocab_size):
+        # the text comes back exactly from decode: no normalization, the newlines are a token of their own
+        # and a character never seen in training falls back to its utf-8 bytes instead of <unk>;
+        # a big corpus is sampled down to a million lines for the training
+        spm.SentencePieceTrainer.Train(input=input_file, model_prefix=model_prefix, vocab_size=vocab_size,
+                                       normalization_rule_name='identity', remove_extra_whitespaces=False,
+                                       add_dummy_prefix=False, user_defined_symbols=['\n'], byte_fallback=True,
+                                       character_coverage=1.0, input_sentence_size=1000000,
+                                       shuffle_input_sentence=True, minloglevel=2)
+        return cls(model_prefix + '.model')
+
+    @staticmethod
+    def lines(text):
+        # a token never spans a newline, so the lines are encoded independently (and in parallel)
+        parts = text.split('\n')
+        return [part + '\n' for part in parts[:-1]] + ([parts[-1]] if parts[-1] else [])
+
+    def encode(self, text, dtype=np.int64, num_threads=None):
+        # the lines are spread over num_threads threads of sentencepiece (default: one per core)
+        ids = self.processor.encode(self.lines(text), num_threads=num_threads or os.cpu_count() or 1)
+        return np.fromiter(itertools.chain.from_iterable(ids), dtype=dtype)
+
+    def decode(self, ids):
+        return self.processor.decode(np.asarray(ids, dtype=np.int64).reshape(-1).tolist())
+
+    def decode_batch(self, sequences):
+        return self.processor.decode([np.asarray(seq, dtype=np.int64).reshape(-1).tolist() for seq in sequences])